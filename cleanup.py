@@ -1,18 +1,37 @@
 #!/usr/bin/env python
 import click
+import errno
+import fnmatch
 import hashlib
 import logging
+import os
 import re
+import sys
 import yaml
 
-from collections import OrderedDict
+from collections import deque
 from collections.abc import Mapping
-from fnmatch import fnmatch
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from functools import lru_cache
+from itertools import islice
+from operator import attrgetter
 from pathlib import Path
-from typing import Pattern, Optional
+from typing import Optional
 
+try:
+    import hyperscan
+except ImportError:  # optional, see compile_hyperscan()
+    hyperscan = None
 
 FILE_MAX_SIZE_WITH_HASH_CHECK = 20_000_000
+FILENAME_CACHE_SIZE = 65536
+HASH_CHUNK_SIZE = 1 << 20
+CONFIG_SECTIONS = ("remove", "remove_hash", "cleanup")
+CONFIG_CACHE_DIR = (
+    Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / "filename-cleanup"
+)
+REPORT_BATCH_SIZE = 10000  # the remove list is printed (and pruned) in batches while scanning
 
 logging.basicConfig()
 logger = logging.getLogger("cleanup")
@@ -25,19 +44,86 @@ GLYPH_SPACE = "    "
 GLYPH_BRANCH = "│   "
 GLYPH_TEE = "├── "
 GLYPH_LAST = "└── "
+MARK_REMOVE = click.style("[-] ", fg="red")
+MARK_RENAME = click.style("[*] ", fg="yellow")
+BADGES = {True: ("cyan", "/"), False: ("green", "")}  # is_dir => (color, trailing slash)
 
 global_options = {}
 patterns = {
-    "remove": [],
-    "remove_hash": [],
-    "cleanup": [],
-}
-pending_list = {
-    "remove": [],
+    "remove": [],  # regex, and globs translated to regex
+    "remove_ascii": [],  # the same, for ASCII names only, see ascii_safe()
+    "remove_labels": [],  # the remove patterns as configured
+    "remove_re": None,  # union of the remove patterns
+    "remove_re_ascii": None,
+    "remove_hs": None,  # hyperscan database of the remove patterns, see compile_hyperscan()
+    "remove_hash": set(),
     "cleanup": [],
-    "normal": [],
+    "cleanup_ascii": [],
+    "cleanup_re": None,  # union of the cleanup patterns
+    "cleanup_re_ascii": None,
+    "any_re": None,  # union of the remove and the cleanup patterns
+    "any_re_ascii": None,
+    "any_hs": None,  # hyperscan database of the remove and the cleanup patterns
+    "match_filename": None,  # see compile_match_filename()
 }
-statistics = {"removed": 0, "renamed": 0, "dir-total-count": 0, "file-total-count": 0}
+
+
+@dataclass(frozen=True)
+class ScanOptions:
+    """what a scan does, resolved once from global_options and the loaded patterns"""
+
+    remove: bool  # by name, nothing to match without remove patterns
+    remove_by_hash: bool  # nothing to match without hashes
+    rename: bool  # nothing to match without cleanup patterns
+    remove_empty_dirs: bool
+    list_removed: bool  # with --no-remove the removed empty dirs are only counted
+    skip_parent_tmp: bool
+    list_remaining: bool  # the tree of remaining files needs -v
+    prune: bool
+    jobs: int
+
+    @property
+    def report_removed(self):
+        """print the remove list while scanning, no need to keep all of it. with --prune each
+        batch is removed too, unless -v lists the remaining files: then they wait for the end
+        """
+        return self.list_removed and not (self.prune and self.list_remaining)
+
+
+def get_scan_options():
+    feature_remove = global_options["feature_remove"]
+    return ScanOptions(
+        remove=feature_remove and bool(patterns["remove"]),
+        remove_by_hash=(
+            feature_remove and bool(global_options.get("feature_remove_by_hash"))
+            and bool(patterns["remove_hash"])
+        ),
+        rename=global_options["feature_rename"] and bool(patterns["cleanup"]),
+        remove_empty_dirs=global_options["feature_remove_empty_dirs"],
+        list_removed=feature_remove,
+        skip_parent_tmp=global_options["skip_parent_tmp"],
+        list_remaining=bool(global_options.get("verbose")),
+        prune=bool(global_options.get("prune")),
+        jobs=global_options.get("jobs", 1),
+    )
+
+
+@dataclass
+class ScanState:
+    """pending changes and statistics of a scan"""
+
+    # the file types are recorded by the scan, so printing and pruning need no more stat() calls.
+    # is_dir follows symlinks like Path.is_dir(). the parent dir is a str, as str(path.parent)
+    # would be: it is shared by the items of the same dir, and needs no Path to print
+    remove: list = field(default_factory=list)  # (parent, name, pattern, is_dir, is_symlink)
+    cleanup: list = field(default_factory=list)  # (parent, name, new filename, is_dir)
+    normal: list = field(default_factory=list)  # remaining (path, symlink target or None)
+    reported: bool = False  # the summary is started, see report_removed
+    removed: int = 0
+    renamed: int = 0
+    dir_count: int = 0
+    file_count: int = 0
+    skipped: int = 0  # items left alone after a read error while pruning, see recursive_cleanup
 
 
 def uniq_list_keep_order(seq):
@@ -63,137 +149,815 @@ def guess_path(test_file, guess_paths=None):
             return file_path
 
 
+GLOBAL_FLAGS_RE = re.compile(r"\(\?([aimsu]+)\)")
+
+
+def scope_global_flags(source):
+    """turn leading global inline flags into a scoped group, "(?i)foo" => "(?i:foo)"
+
+    global flags are only allowed at the start of the whole pattern, not inside a union.
+    verbose (?x) is left alone, a trailing "# comment" would swallow the closing parenthesis
+    """
+    flags = ""
+    m = GLOBAL_FLAGS_RE.match(source)
+    while m:
+        flags += m.group(1)
+        source = source[m.end():]
+        m = GLOBAL_FLAGS_RE.match(source)
+    return f"(?{flags}:{source})" if flags else source
+
+
+# \w \d \s \b, escapes of non-ASCII characters (\xe9 \u00e9 \N{...} octal), back-references,
+# (?u) (?L)
+NOT_ASCII_SAFE_RE = re.compile(r"\\[wWdDsSbBxuUN0-9]|\(\?P=|\(\?[a-zA-Z]*[uL]")
+
+
+def ascii_safe(source):
+    """whether the regex source matches ASCII names the same with re.ASCII, which folds case faster
+
+    ASCII text that stands for ASCII only: not \\w \\d \\s \\b, their ASCII versions are
+    narrower, nor escapes of non-ASCII letters and back-references, which would lose their case
+    folding. names with a non-ASCII letter which folds to an ASCII one, e.g. "\u212a" (KELVIN SIGN)
+    to "k", are matched differently: they are not ASCII, the patterns without re.ASCII take them
+    """
+    return source.isascii() and not NOT_ASCII_SAFE_RE.search(source)
+
+
+def regex_flags(source):
+    return re.IGNORECASE | re.ASCII if ascii_safe(source) else re.IGNORECASE
+
+
+NUMBERED_REF_RE = re.compile(r"\\[1-9]|\(\?\(\d")  # \1, (?(1)yes|no)
+
+
+def compile_union(sources, ascii=False):
+    """combine regex sources into one alternation, so a single search tells whether any of them
+    matches, not which one. with `ascii`, the ASCII-safe sources match with re.ASCII: the union
+    is for ASCII names only
+
+    the sources are not wrapped in capturing groups: they keep re from optimizing the alternation,
+    a search gets several times slower. which pattern matches is found by trying them in order,
+    only for the names the union matches. return None if the union can not be compiled, e.g. a
+    source with global inline flags other than at its start, or would match differently: groups
+    are numbered across the union, a numbered back-reference would refer to another source's group
+    """
+    if not sources or any(NUMBERED_REF_RE.search(source) for source in sources[1:]):
+        return None
+    union = "|".join(
+        f"(?a:{scope_global_flags(source)})" if ascii and ascii_safe(source)
+        else f"(?:{scope_global_flags(source)})"
+        for source in sources
+    )
+    try:
+        return re.compile(union, flags=re.IGNORECASE)
+    except re.error:
+        return None
+
+
+HS_QUANTIFIER_RE = re.compile(r"\{(\d*)(,?)(\d*)\}")
+HS_FLAGS_RE = re.compile(r"\(\?([aiLmsux]*)(?:-([imsx]+))?([:)])")
+HS_ESCAPES = "AZbBdDSwWtnrfva"  # the same for hyperscan as for re, on ASCII names
+HS_CLASS_ESCAPES = "dDwWtnrfva"
+
+
+def hyperscan_source(source):
+    """translate a regex source for hyperscan, which reads some of the python syntax differently
+
+    the result matches at least the ASCII names the source matches, re confirms the hits. e.g.
+    "x{,3}" is a literal to hyperscan, it is rewritten "x{0,3}". atomic groups and possessive
+    quantifiers only narrow the match, they are dropped. return None for what can not be
+    translated: back-references, lookarounds, escapes of non-ASCII characters...
+    """
+    out = []
+    i = 0
+    quantified = False  # a "+" after a quantifier makes it possessive
+    while i < len(source):
+        c = source[i]
+        if quantified and c == "+":
+            i += 1
+            quantified = False
+            continue
+        quantified = False
+        if c == "\\":
+            e = source[i + 1:i + 2]
+            if e == "s":
+                out.append(r"[\s\x1c-\x1f]")  # python \s matches \x1c-\x1f too
+            elif e and (e in HS_ESCAPES or e.isascii() and not e.isalnum()):
+                out.append(c + e)
+            else:
+                return None
+            i += 2
+        elif c == "[":
+            j = i + 1
+            j += source.startswith("^", j)
+            j += source.startswith("]", j)  # a literal "]" first
+            while j < len(source) and source[j] != "]":
+                if source[j] == "\\":
+                    e = source[j + 1:j + 2]
+                    if not (e and (e in HS_CLASS_ESCAPES or e.isascii() and not e.isalnum())):
+                        return None
+                    j += 1
+                elif source[j] == "[" or not source[j].isascii():
+                    return None
+                j += 1
+            out.append(source[i:j + 1])
+            i = j + 1
+        elif c == "(" and source.startswith("(?", i):
+            m = HS_FLAGS_RE.match(source, i)
+            if source.startswith(("(?P<", "(?>"), i):
+                out.append("(" if source[i + 2] == "P" else "(?:")
+                i = source.index(">", i) + 1 if source[i + 2] == "P" else i + 3
+            elif m and "x" not in m.group(1) + (m.group(2) or ""):
+                on = re.sub("[auL]", "", m.group(1))  # unicode/ascii only, not for hyperscan
+                flags = on + (f"-{m.group(2)}" if m.group(2) else "")
+                if flags or m.group(3) == ":":
+                    out.append(f"(?{flags}{m.group(3)}")
+                i = m.end()
+            else:
+                return None
+        elif c == "{":
+            m = HS_QUANTIFIER_RE.match(source, i)
+            if m and (m.group(1) or m.group(2)):
+                lo, comma, hi = m.groups()
+                out.append(f"{{{lo or 0}{comma}{hi}}}")
+                i = m.end()
+                quantified = True
+            else:
+                out.append(r"\{")
+                i += 1
+        elif c in "*+?":
+            out.append(c)
+            i += 1
+            quantified = True
+        else:
+            if not c.isascii() and (c.lower().isascii() or c.upper().isascii()):
+                return None  # e.g. "\u212a" (KELVIN SIGN) matches "k"
+            out.append(c)
+            i += 1
+    return "".join(out)
+
+
+def build_hyperscan_database(sources):
+    """sources: {id: hyperscan expression}, return None if hyperscan can not compile them"""
+    flags = (
+        hyperscan.HS_FLAG_CASELESS | hyperscan.HS_FLAG_UTF8 | hyperscan.HS_FLAG_SINGLEMATCH
+        | hyperscan.HS_FLAG_ALLOWEMPTY
+    )
+    db = hyperscan.Database()
+    try:
+        db.compile(
+            expressions=[source.encode() for source in sources.values()],
+            ids=list(sources),
+            elements=len(sources),
+            flags=[flags] * len(sources),
+        )
+    except hyperscan.error:
+        return None
+    return db
+
+
+def compile_hyperscan(regex_list):
+    """compile regex patterns into a hyperscan database, which scans all of them in one pass
+
+    a scan finds at least the patterns which match, see hyperscan_source(). only ASCII names are
+    scanned, so the database needs no unicode properties, which compile a lot slower. the patterns
+    hyperscan can not take are left out, they are tried with re. return (database, indexes of the
+    patterns left out), or None if hyperscan is not installed or takes none of the patterns
+    """
+    if hyperscan is None:
+        return None
+    sources = {}
+    for i, p in enumerate(regex_list):
+        source = hyperscan_source(p.pattern)
+        if source is not None:
+            sources[i] = source
+    db = build_hyperscan_database(sources) if sources else None
+    if db is None and len(sources) > 1:  # find the patterns hyperscan rejects, and leave them out
+        sources = {i: s for i, s in sources.items() if build_hyperscan_database({i: s})}
+        db = build_hyperscan_database(sources) if sources else None
+    if db is None:
+        return None
+    return db, [i for i in range(len(regex_list)) if i not in sources]
+
+
+def glob_to_regex(pattern):
+    """translate a glob to a regex source, which matches the whole name like fnmatch()
+
+    case-sensitive, unless os.path.normcase() folds the case (Windows) like fnmatch()
+    """
+    source = rf"\A{fnmatch.translate(pattern)}"  # translate() anchors the end only
+    return source if os.path.normcase("A") == "a" else f"(?-i:{source})"
+
+
+def read_config(filename):
+    """parse the yml config, return its CONFIG_SECTIONS as a dict
+
+    the sections are cached in CONFIG_CACHE_DIR, "\\0"-separated, in a file named by the hash of
+    the config content: it is never stale, and a hit skips the yaml parser
+    """
+    with open(filename, "rb") as f:
+        content = f.read()
+    cache_file = CONFIG_CACHE_DIR / hashlib.blake2b(content, digest_size=16).hexdigest()
+    try:
+        with cache_file.open(encoding="utf8", newline="") as f:
+            sections = f.read().split("\0")
+        if len(sections) == len(CONFIG_SECTIONS):
+            return dict(zip(CONFIG_SECTIONS, sections))
+    except (OSError, ValueError):
+        pass
+
+    config = yaml.load(content.decode("utf8"), Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+    sections = [config.get(key, "") for key in CONFIG_SECTIONS]
+    if not all(isinstance(i, str) and "\0" not in i for i in sections):
+        return config  # not cached, left to load_patterns as it is
+    tmp_file = cache_file.with_name(f"{cache_file.name}.{os.getpid()}.tmp")
+    try:
+        CONFIG_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+        with tmp_file.open("w", encoding="utf8", newline="") as f:
+            f.write("\0".join(sections))
+        os.replace(tmp_file, cache_file)  # readers never see a partial file
+    except OSError as e:  # read-only cache dir
+        logger.debug(f"config not cached: {e}")
+        tmp_file.unlink(missing_ok=True)
+    return dict(zip(CONFIG_SECTIONS, sections))
+
+
 def load_patterns(filename):
-    with open(filename, encoding="utf8") as f:
-        config = yaml.safe_load(f)
+    config = read_config(filename)
+    # globs are translated to regex, so all remove patterns match the same way
     for line in config.get("remove", "").splitlines():
-        patterns["remove"].append(
-            re.compile(line[1:], flags=re.IGNORECASE) if line.startswith("/") else line
-        )
+        regex = line.startswith("/")
+        source = line[1:] if regex else glob_to_regex(line)
+        patterns["remove"].append(re.compile(source, flags=re.IGNORECASE))
+        patterns["remove_ascii"].append(re.compile(source, flags=regex_flags(source)))
+        patterns["remove_labels"].append(line[1:] if regex else line)
     for line in config.get("remove_hash", "").splitlines():
-        patterns["remove_hash"].append(line)
+        patterns["remove_hash"].add(line)
     for line in config.get("cleanup", "").splitlines():
-        patterns["cleanup"].append(re.compile(line, flags=re.IGNORECASE))
+        # a blank line removes nothing, but would match every name and defeat cleanup_re
+        if line:
+            patterns["cleanup"].append(re.compile(line, flags=re.IGNORECASE))
+            patterns["cleanup_ascii"].append(re.compile(line, flags=regex_flags(line)))
 
+    # the unions for ASCII names, the most of them, fold case with re.ASCII where it is safe
+    for key, sources in (
+        ("remove", [p.pattern for p in patterns["remove"]]),
+        ("cleanup", [p.pattern for p in patterns["cleanup"]]),
+        ("any", [p.pattern for p in patterns["remove"] + patterns["cleanup"]]),
+    ):
+        patterns[f"{key}_re"] = compile_union(sources)
+        patterns[f"{key}_re_ascii"] = compile_union(sources, ascii=True)
+    if patterns["remove_re"] is not None:
+        patterns["remove_hs"] = compile_hyperscan(patterns["remove"])
+    if patterns["any_re"] is not None:
+        patterns["any_hs"] = compile_hyperscan(patterns["remove"] + patterns["cleanup"])
+    # cached results are only valid for the patterns they were computed with
+    match_remove_pattern.cache_clear()
+    clean_filename.cache_clear()
+    patterns["match_filename"] = compile_match_filename(
+        remove=global_options.get("feature_remove", True),
+        rename=global_options.get("feature_rename", True),
+    )
 
-def match_remove_pattern(filename):
-    for p in patterns["remove"]:
-        if isinstance(p, Pattern):
-            matched = p.search(str(filename))
-            pat = p.pattern
-        else:
-            matched = fnmatch(filename, p)
-            pat = p
+
+def compile_match_filename(remove=True, rename=True):
+    """build match_filename(name) for the loaded patterns, see patterns["match_filename"]
+
+    it matches a name with the remove and the cleanup patterns, only those of the enabled
+    features, and returns (matched, pattern, new filename). most names match neither of them, a
+    single search sorts them out. what it uses is bound as default arguments, looked up once here
+    instead of per call
+    """
+    any_re = patterns["any_re"]
+    any_re_ascii = patterns["any_re_ascii"]
+    any_hs = patterns["any_hs"]
+    if not rename:  # the remove patterns have their own prefilter
+
+        def match_filename(filename, _match_remove=match_remove_pattern):
+            return (*_match_remove(filename), filename)
+
+    elif not remove:
+
+        def match_filename(filename, _clean=clean_filename):
+            return False, None, _clean(filename)
+
+    elif any_re is None or any_re_ascii is None:
+
+        def match_filename(filename, _match_remove=match_remove_pattern, _clean=clean_filename):
+            return (*_match_remove(filename), _clean(filename))
+
+    elif any_hs is not None:  # the union of many patterns is much faster with hyperscan
+        db, rest = any_hs
+        regex_list = patterns["remove_ascii"] + patterns["cleanup_ascii"]  # only ASCII is scanned
+
+        def match_filename(
+            filename,
+            _scan=db,
+            _rest=[regex_list[i].search for i in rest],  # left out of the database
+            _search=any_re.search,
+            _match_remove=match_remove_pattern,
+            _clean=clean_filename,
+        ):
+            hits = scan_hyperscan(_scan, filename)
+            if hits is None:
+                found = _search(filename)
+            else:
+                found = hits or any(search(filename) for search in _rest)
+            if not found:
+                return False, None, filename
+            return (*_match_remove(filename), _clean(filename))
+
+    else:
+
+        def match_filename(
+            filename,
+            _search=any_re.search,
+            _search_ascii=any_re_ascii.search,
+            _match_remove=match_remove_pattern,
+            _clean=clean_filename,
+        ):
+            if not (_search_ascii if filename.isascii() else _search)(filename):
+                return False, None, filename
+            return (*_match_remove(filename), _clean(filename))
+
+    return lru_cache(maxsize=FILENAME_CACHE_SIZE)(match_filename)
+
+
+def scan_hyperscan(db, filename):
+    """return the ids of the patterns of the hyperscan database which match the filename,
+    or None if the filename can not be scanned
+    """
+    if not filename.isascii():  # the database folds the case of ASCII letters only
+        return None
+    hits = []
+    db.scan(filename.encode(), match_event_handler=lambda i, *_: hits.append(i))
+    return hits
+
+
+def match_hyperscan(filename):
+    """scan with the hyperscan database of the remove patterns
+
+    return (matched, pattern), or None if the filename can not be scanned
+    """
+    db, rest = patterns["remove_hs"]
+    hits = scan_hyperscan(db, filename)
+    if hits is None:
+        return None
+    # confirm with re, in the order of the config. the pattern reported is the same as without
+    # hyperscan, and a hit of the wider translation can not remove a file
+    for i in sorted(hits + rest):
+        matched = patterns["remove_ascii"][i].search(filename)
+        if matched:
+            return matched, patterns["remove_labels"][i]
+    return False, None
+
+
+@lru_cache(maxsize=FILENAME_CACHE_SIZE)
+def match_remove_pattern(filename: str):
+    """filename: the name only (str), not a Path"""
+    if patterns["remove_hs"] is not None:
+        matched = match_hyperscan(filename)
+        if matched is not None:
+            return matched
+    ascii = filename.isascii()
+    remove_re = patterns["remove_re_ascii" if ascii else "remove_re"]
+    if remove_re is not None and not remove_re.search(filename):
+        return False, None
+    # the first pattern in the order of the config which matches. the union matches at the
+    # leftmost position, which may be another pattern's
+    for p, pat in zip(patterns["remove_ascii" if ascii else "remove"], patterns["remove_labels"]):
+        matched = p.search(filename)
         if matched:
             return matched, pat
     return False, None
 
 
 def match_remove_hash(target_file: Path) -> tuple[bool, Optional[str]]:
-    # match hash
+    # match hash, read in chunks instead of the whole file at once
     with target_file.open("rb") as f:
-        md5sum = hashlib.md5(f.read()).hexdigest()
-        if md5sum in patterns["remove_hash"]:
-            return True, md5sum
+        if hasattr(hashlib, "file_digest"):  # python 3.11+
+            md5 = hashlib.file_digest(f, "md5")
+        else:
+            md5 = hashlib.md5()
+            while chunk := f.read(HASH_CHUNK_SIZE):
+                md5.update(chunk)
+    md5sum = md5.hexdigest()
+    if md5sum in patterns["remove_hash"]:
+        return True, md5sum
     return False, None
 
 
+@lru_cache(maxsize=FILENAME_CACHE_SIZE)
 def clean_filename(filename):
-    for p in patterns["cleanup"]:
+    # the union only tells whether any pattern applies at all. the patterns still run one by one,
+    # each one works on the result of the previous one (e.g. "^[-_@]+" after a prefix is removed)
+    ascii = filename.isascii()  # a name only gets shorter, an ASCII name stays ASCII
+    cleanup_re = patterns["cleanup_re_ascii" if ascii else "cleanup_re"]
+    if cleanup_re is not None and not cleanup_re.search(filename):
+        return filename
+    for p in patterns["cleanup_ascii" if ascii else "cleanup"]:
         filename = p.sub("", filename)
     return filename
 
 
+IGNORED_ERRNOS = (errno.ENOENT, errno.ENOTDIR, errno.EBADF, errno.ELOOP)  # as pathlib
+
+
+def entry_is_dir(entry):
+    """entry.is_dir(), False for a broken entry (e.g. a symlink loop) like Path.is_dir().
+    os.DirEntry raises ELOOP instead
+    """
+    try:
+        return entry.is_dir()
+    except OSError as e:
+        if e.errno not in IGNORED_ERRNOS:
+            raise
+        return False
+
+
+def entry_is_file(entry):
+    """entry.is_file(), False for a broken entry like Path.is_file(), see entry_is_dir()"""
+    try:
+        return entry.is_file()
+    except OSError as e:
+        if e.errno not in IGNORED_ERRNOS:
+            raise
+        return False
+
+
+def scan_dir(path):
+    """list the entries of a dir, return (dirs, files), 目录优先
+
+    the dirs are sorted by name, they are walked in that order. the files are not, most of them
+    are not reported, cleanup_files sorts the ones which are. symlinks to dirs count as dirs,
+    like Path.is_dir()
+    """
+    dirs = []
+    files = []
+    with os.scandir(path) as it:
+        for e in it:
+            (dirs if entry_is_dir(e) else files).append(e)
+    dirs.sort(key=attrgetter("name"))
+    return dirs, files
+
+
+def list_subtree(path, collect=True):
+    """list everything under a dir in one pass, bottom-up: children come before their parent dir
+
+    return (children, child_count, dir_count), children as items of ScanState.remove,
+    only collected if `collect`. like Path.is_dir(), symlinks count by their targets,
+    but are not followed into. like Path.glob(), dirs which can not be read are skipped
+    """
+    children = []
+    child_count = 0
+    dir_count = 0
+    dirs = [str(path)]
+    while dirs:
+        parent = dirs.pop()
+        try:
+            it = os.scandir(parent)
+        except PermissionError:
+            continue
+        with it:
+            for e in it:
+                child_count += 1
+                is_dir = entry_is_dir(e)
+                if collect:
+                    children.append((parent, e.name, "Pruning branches", is_dir, e.is_symlink()))
+                if is_dir:
+                    dir_count += 1
+                    if not e.is_symlink():
+                        # as str(Path(e.path)): "./a" is "a"
+                        dirs.append(e.name if parent == "." else os.path.join(parent, e.name))
+    children.reverse()  # every dir is listed before its children
+    return children, child_count, dir_count
+
+
+def find_file(dirs, top, found):
+    """search the dirs (under `top`) and their subtrees for a file, breadth-first
+
+    stop at the first one, and add the dirs between `top` and it to `found`: their subtrees are
+    known not to be empty. like Path.is_file(), symlinks count by their targets. a dir which can
+    not be read is not known to be empty either, it counts as a file
+    """
+    queue = deque(dirs)
+    while queue:
+        d = queue.popleft()
+        has_file = True
+        try:
+            it = os.scandir(d)
+        except PermissionError:
+            pass
+        else:
+            with it:
+                has_file = False
+                for e in it:
+                    if entry_is_dir(e):
+                        if not e.is_symlink():
+                            queue.append(e.path)
+                    elif entry_is_file(e):
+                        has_file = True
+                        break
+        if has_file:
+            p = Path(d)
+            while p != top and p not in found:
+                found.add(p)
+                p = p.parent
+            return True
+    return False
+
+
+def cleanup_files(nodes, state, options, executor=None):
+    """cleanup a batch of files (anything but real dirs, symlinks included) of the same dir
+
+    nodes: os.DirEntry items of the dir, or the Path of a file target
+    options: ScanOptions of the scan
+    executor: hashes the files in parallel if given
+    """
+    match_name = options.remove
+    match_hash = options.remove_by_hash
+    enabled_rename = options.rename
+    list_remaining = options.list_remaining
+
+    # skip .tmp in parents dir, no parents of the batch are .tmp, or it would not be scanned
+    if options.skip_parent_tmp:
+        nodes = [x for x in nodes if x.name != ".tmp"]
+
+    match_any = match_name or enabled_rename
+    match_filename = patterns["match_filename"]
+    results = []
+    hash_check = []  # indexes of results to check by hash
+    for node in nodes:
+        name = node.name
+        matched, pat, new_filename = match_filename(name) if match_any else (False, None, name)
+        # try match hash if file size <= 20Mb
+        if (
+            match_hash and not matched and entry_is_file(node)
+            and node.stat().st_size <= FILE_MAX_SIZE_WITH_HASH_CHECK
+        ):
+            hash_check.append(len(results))
+        results.append((node, matched, pat, new_filename))
+    # read the files in inode order, closer to their layout on disk than the name order.
+    # the results keep the name order
+    if len(hash_check) > 1:
+        hash_check.sort(key=lambda i: results[i][0].inode())
+    hash_files = [Path(results[i][0]) for i in hash_check]
+    if executor is not None and len(hash_files) > 1:  # md5 releases the GIL on large chunks
+        hashed = executor.map(match_remove_hash, hash_files)
+    else:
+        hashed = map(match_remove_hash, hash_files)
+    for i, matched in zip(hash_check, hashed):
+        node, _, _, new_filename = results[i]
+        results[i] = (node, *matched, new_filename)
+
+    removed = []
+    renamed = []
+    remaining = []
+    for item in results:
+        node, matched, _, new_filename = item
+        if matched:
+            removed.append(item)
+        elif enabled_rename and new_filename != node.name:
+            renamed.append(item)
+        elif list_remaining:  # remaining files
+            remaining.append(item)
+    # the files are listed unsorted, only the reported ones are sorted by name
+    for items in (removed, renamed, remaining):
+        items.sort(key=lambda item: item[0].name)
+    parent = str(Path(nodes[0]).parent) if removed or renamed else None  # the same for all
+    removed = [
+        (parent, node.name, pat, entry_is_dir(node), node.is_symlink())
+        for node, _, pat, _ in removed
+    ]
+    renamed = [
+        (parent, node.name, new_filename, entry_is_dir(node))
+        for node, _, _, new_filename in renamed
+    ]
+    # the link targets are read now, a parent dir may be renamed before the tree is printed
+    remaining = [
+        (Path(node), str(Path(os.readlink(node))) if node.is_symlink() else None)
+        for node, *_ in remaining
+    ]
+    # the state is only changed once everything is read, see recursive_cleanup
+    state.file_count += len(nodes)
+    state.remove.extend(removed)
+    state.removed += len(removed)
+    state.cleanup.extend(renamed)
+    state.renamed += len(renamed)
+    state.normal.extend(remaining)
+
+
 def recursive_cleanup(target_path):
-    enabled_remove = global_options["feature_remove"]
-    enabled_rename = global_options["feature_rename"]
-    enabled_remove_empty_dirs = global_options["feature_remove_empty_dirs"]
-    feature_remove_by_hash = global_options.get("feature_remove_by_hash")
-    skip_parent_tmp = global_options["skip_parent_tmp"]
-
-    t = Path(target_path)
-    is_dir = t.is_dir() and not t.is_symlink()  # do not follow symlinks, linux vs macOS
-    # skip .tmp in sub-dirs
-    if is_dir and ".tmp" == str(t.name):
-        return
-    # skip .tmp in parents dir
-    if skip_parent_tmp and ".tmp" in t.parts:
-        return
+    """scan the target, return the ScanState of what to remove and rename"""
+    options = get_scan_options()
+    enabled_remove = options.remove
+    enabled_rename = options.rename
+    enabled_remove_empty_dirs = options.remove_empty_dirs
+    skip_parent_tmp = options.skip_parent_tmp
+    list_remaining = options.list_remaining
+    report_removed_batch = options.report_removed
+    prune_batch = report_removed_batch and options.prune
+    jobs = options.jobs
+
+    state = ScanState()
+    remove_list = state.remove
+    cleanup_list = state.cleanup
+    normal_list = state.normal
+
+    target = Path(target_path)
+    # skip .tmp in parents dir. the .tmp dirs below the target are skipped by name and never
+    # entered, only the target itself can be under one: checked once, not for every dir
+    if skip_parent_tmp and ".tmp" in target.parts:
+        return state
+    if not target.is_dir() or target.is_symlink():  # do not follow symlinks, linux vs macOS
+        cleanup_files([target], state, options)
+        return state
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        # dirs are pushed as ("dir", path), and once more as ("dir-done", path) before their
+        # children, so they are finished (counted, renamed) after all of them. the files of a dir
+        # are pushed as one ("files", [DirEntry, ...]) batch, see cleanup_files
+        stack = [("dir", target)]
+        listings = {}  # path => future of scan_dir(path), read ahead by the executor
+        read_ahead = 2 * jobs  # at most so many listings are pending, each holds a whole dir
+        not_empty = set()  # dirs with a file in their subtree, found by the empty-dir checks
+        while stack:
+            if report_removed_batch and len(remove_list) >= REPORT_BATCH_SIZE:
+                report_removed(state, prune_batch)
+            if jobs > 1 and len(listings) < read_ahead:
+                # read ahead the next dirs to pop, found near the top of the stack
+                for action, t in islice(reversed(stack), 4 * read_ahead):
+                    if action == "dir" and t not in listings:
+                        listings[t] = executor.submit(scan_dir, t)
+                        if len(listings) >= read_ahead:
+                            break
+            action, t = stack.pop()
+            try:
+                if action == "files":
+                    cleanup_files(t, state, options, executor if jobs > 1 else None)
+                    continue
+
+                if action == "dir-done":
+                    not_empty.discard(t)
+                    state.dir_count += 1
+                    if enabled_rename:
+                        new_filename = clean_filename(t.name)
+                        if new_filename != t.name:
+                            state.renamed += 1
+                            cleanup_list.append((str(t.parent), t.name, new_filename, True))
+                            continue  # skip early
+                    # remaining dirs
+                    if list_remaining:
+                        normal_list.append((t, None))
+                    continue
+
+                listing = listings.pop(t, None)
+                # skip .tmp in sub-dirs
+                if ".tmp" == t.name:
+                    continue
 
-    if enabled_remove or enabled_remove_empty_dirs:
-        children = (
-            [(x, "Pruning branches") for x in reversed(list(t.glob("**/*")))] if is_dir else []
+                if enabled_remove:
+                    matched, pat = match_remove_pattern(t.name)
+                    if matched:  # remove dir and all children
+                        children, child_count, dir_count = list_subtree(t)
+                        remove_list.extend(children)
+                        remove_list.append((str(t.parent), t.name, pat, True, False))
+                        state.removed += child_count + 1
+                        state.dir_count += dir_count + 1
+                        state.file_count += child_count - dir_count
+                        continue  # skip early
+
+                try:
+                    subdirs, files = scan_dir(t) if listing is None else listing.result()
+                except PermissionError as e:
+                    # counted and renamed like a dir without children, but never removed as empty
+                    logger.warning(f"not read: {e}")
+                    subdirs, files = [], []
+                    not_empty.add(t)
+
+                # empty dirs, without a file in the subtree. the search stops at the first file, the
+                # subtree is only listed in full when it is removed
+                if (
+                    enabled_remove_empty_dirs and t not in not_empty
+                    and not any(entry_is_file(e) for e in files)
+                    and not find_file([e.path for e in subdirs if not e.is_symlink()], t, not_empty)
+                ):
+                    # with --no-remove the removed items are only counted, not listed or removed
+                    children, child_count, dir_count = list_subtree(t, collect=options.list_removed)
+                    remove_list.extend(children)
+                    remove_list.append((str(t.parent), t.name, "Remove empty dirs", True, False))
+                    state.removed += child_count + 1
+                    state.dir_count += dir_count + 1
+                    continue  # skip early
+
+                stack.append(("dir-done", t))
+                stack.append(("files", files))
+                # pushed in reverse, popped in order, 深度优先
+                for e in reversed(subdirs):
+                    # symlinks to dirs are sorted with the dirs, but cleaned as files
+                    stack.append(("files", [e]) if e.is_symlink() else ("dir", Path(e.path)))
+            except OSError as e:
+                # once a batch is pruned, giving up would leave the renames undone: what can not
+                # be read is left alone instead, and only counted. nothing else is recorded for
+                # it, the state is only changed after the reads
+                if not (prune_batch and state.reported):
+                    raise
+                logger.warning(f"skipped: {e}")
+                state.skipped += len(t) if action == "files" else 1
+    return state
+
+
+def format_remove_list(remove_list):
+    """the summary lines of ScanState.remove items"""
+    verbose = global_options.get("verbose", 0)
+    lines = []
+    for parent, name, pat, is_dir, _ in remove_list:
+        color, trailing_slash = BADGES[is_dir]
+        name = f"{name}{trailing_slash}"
+        if pat:
+            name = click.style(name, fg=color)
+        lines.append(
+            f"{MARK_REMOVE}{parent}/{name}{f' <= {pat}' if verbose >= 3 and pat else ''}"
         )
-        if enabled_remove:
-            matched, pat = match_remove_pattern(t.name)
-            # try match hash if file size <= 20Mb
-            if (
-                feature_remove_by_hash and patterns["remove_hash"] and not matched
-                and t.is_file() and t.stat().st_size <= FILE_MAX_SIZE_WITH_HASH_CHECK
-            ):
-                matched, pat = match_remove_hash(t)
-            if matched:
-                if is_dir:  # remove dir and all children
-                    pending_list["remove"].extend(children)
-                    statistics["removed"] += len(children)
-                    statistics["dir-total-count"] += (
-                        len([1 for x, _ in children if x.is_dir()]) + 1
-                    )
-                    statistics["file-total-count"] += len(
-                        [1 for x, _ in children if not x.is_dir()]
-                    )
-                else:
-                    statistics["file-total-count"] += 1
-                pending_list["remove"].append((t, pat))
-                statistics["removed"] += 1
-                return  # return early
-
-        # empty dirs
-        if enabled_remove_empty_dirs:
-            if is_dir and not any([x for x, _ in children if x.is_file()]):
-                pending_list["remove"].extend(children)
-                pending_list["remove"].append((t, "Remove empty dirs"))
-                statistics["removed"] += len(children) + 1
-                statistics["dir-total-count"] += len([1 for x, _ in children if x.is_dir()]) + 1
-                return  # return early
-
-    if is_dir:
-        nodes = sorted(t.iterdir(), key=lambda f: (0 if f.is_dir() else 1, f.name))  # 目录优先/深度优先
-        for item in nodes:
-            recursive_cleanup(item)  # 递归遍历子目录, 深度优先
-        statistics["dir-total-count"] += 1
-    else:
-        statistics["file-total-count"] += 1
+    return lines
 
-    if enabled_rename:
-        new_filename = clean_filename(t.name)
-        if new_filename != t.name:
-            statistics["renamed"] += 1
-            pending_list["cleanup"].append((t, new_filename))
-            return  # return early
-    # remaining dirs/files
-    pending_list["normal"].append(t)
 
+def report_removed(state, prune=False):
+    """print the items of state.remove found so far in the summary, remove them if `prune`,
+    then drop them
 
-def get_badge(i):
-    if i.is_dir():
-        return "cyan", "/"
-    else:
-        return "green", ""
+    the scan is pre-order: the items were checked before their parent dirs were, and are not
+    looked at again. the renames stay pending, they still come after all of the removals
+    """
+    if not state.remove:
+        return
+    if not state.reported:
+        click.echo("\n--- Summary ---")
+        state.reported = True
+    click.echo("\n".join(format_remove_list(state.remove)))
+    if prune:
+        remove_paths(state.remove)
+    state.remove.clear()
+
+
+def parent_dir_fds(items):
+    """yield (dir_fd, item) for (parent, name, ...) items, dir_fd: an open fd of the parent dir
+
+    consecutive items of the same dir share one fd, they are removed/renamed relative to it
+    (unlinkat, renameat), instead of resolving the whole path again for each of them
+    """
+    parent = dir_fd = None
+    try:
+        for item in items:
+            if item[0] != parent:
+                if dir_fd is not None:
+                    os.close(dir_fd)
+                    dir_fd = None
+                parent = item[0]
+                dir_fd = os.open(parent, os.O_RDONLY | getattr(os, "O_DIRECTORY", 0))
+            yield dir_fd, item
+    finally:
+        if dir_fd is not None:
+            os.close(dir_fd)
+
+
+def remove_paths(remove_list):
+    """remove the items of ScanState.remove, in order: children come before their parent dir
+
+    the file types recorded by the scan tell rmdir from unlink, no stat() is needed
+    """
+    if not {os.unlink, os.rmdir} <= os.supports_dir_fd:
+        for parent, name, _, is_dir, is_symlink in remove_list:
+            # do not follow symlink
+            (os.rmdir if is_dir and not is_symlink else os.unlink)(os.path.join(parent, name))
+        return
+    for dir_fd, (_, name, _, is_dir, is_symlink) in parent_dir_fds(remove_list):
+        # do not follow symlink
+        (os.rmdir if is_dir and not is_symlink else os.unlink)(name, dir_fd=dir_fd)
+
+
+def rename_paths(cleanup_list):
+    """rename the items of ScanState.cleanup, in order: children come before their parent dir"""
+    if os.rename not in os.supports_dir_fd:
+        for parent, name, new_filename, _ in cleanup_list:
+            os.rename(os.path.join(parent, name), os.path.join(parent, new_filename))
+        return
+    for dir_fd, (_, name, new_filename, _) in parent_dir_fds(cleanup_list):
+        os.rename(name, new_filename, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
 
 
 def path_list_to_tree_dict(path_list):
-    tree = OrderedDict()
-    for i in path_list:
+    """path_list: (path, symlink target or None) items"""
+    tree = {}  # dict keeps the insertion order
+    for i, link in path_list:
+        parts = i.parts
+        if not parts:  # "."
+            continue
         node = tree
-        for p in i.parts:
-            if p == i.name:
-                if i.is_symlink():
-                    node.setdefault(p, str(i.readlink()))  # leaf
-                else:
-                    node.setdefault(p, None)  # leaf
-            else:
-                node = node.setdefault(p, OrderedDict())  # sub-dir
+        # the last part is the leaf, by position: a parent dir may have the same name
+        for p in parts[:-1]:
+            node = node.setdefault(p, {})  # sub-dir
+        node.setdefault(parts[-1], link)  # leaf
     return tree
 
 
@@ -270,7 +1034,18 @@ def tree_dict_iterator(dir_path, prefix=""):
     "--prune",
     is_flag=True,
     default=False,
-    help="Execute remove and rename files and directories which matched clean patterns",
+    help=(
+        "Execute remove and rename files and directories which matched clean patterns. "
+        "Without -v, files are removed while scanning"
+    ),
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of threads reading dirs ahead of the scan, and hashing files.",
+    show_default=True,
 )
 @click.option("-v", "--verbose", count=True, help="-v=info, -vv=debug")
 def main(
@@ -282,6 +1057,7 @@ def main(
     feature_remove_by_hash,
     skip_parent_tmp,
     prune,
+    jobs,
     verbose,
 ):
     logger.setLevel(LOG_LEVEL[min(verbose, max(LOG_LEVEL))])
@@ -292,6 +1068,8 @@ def main(
     global_options["feature_remove_by_hash"] = feature_remove_by_hash
     global_options["skip_parent_tmp"] = skip_parent_tmp
     global_options["prune"] = prune
+    global_options["jobs"] = jobs
+    global_options["verbose"] = verbose
 
     target = Path(target_path)
 
@@ -313,50 +1091,47 @@ def main(
         load_patterns(cleanup_patterns_file)
 
     # recursive scan the target dir
-    recursive_cleanup(target)
+    state = recursive_cleanup(target)
 
     # cleanup
-    if pending_list["remove"] or pending_list["cleanup"]:
+    if (state.remove or state.cleanup) and not state.reported:
         click.echo("\n--- Summary ---")
 
-    # remove junk files
-    if feature_remove:
-        for i, pat in pending_list["remove"]:
-            click.secho("[-] ", fg="red", nl=False)
-
-            color, trailing_slash = get_badge(i)
-            if not pat:
-                color = None
-            click.echo(f"{i.parent}/", nl=False)
-            click.secho(f"{i.name}{trailing_slash}", fg=color, nl=False)
-            click.echo(f" <= {pat}" if verbose >= 3 and pat else "")
-            if prune:
-                # do not follow symlink
-                i.rmdir() if i.is_dir() and not i.is_symlink() else i.unlink()
+    # remove junk files, the rest of them if some are already printed by the scan
+    if feature_remove and state.remove:
+        # build all the lines, and write them at once
+        click.echo("\n".join(format_remove_list(state.remove)))
+        if prune:
+            remove_paths(state.remove)
 
     # clean/rename filename
-    if feature_rename:
-        for i, new_filename in pending_list["cleanup"]:
-            click.secho("[*] ", fg="yellow", nl=False)
-
-            color, trailing_slash = get_badge(i)
-            old = click.style(i.name, fg=color)
+    if feature_rename and state.cleanup:
+        lines = []
+        for parent, name, new_filename, is_dir in state.cleanup:
+            color, trailing_slash = BADGES[is_dir]
+            old = click.style(name, fg=color)
             new = click.style(new_filename, fg="yellow")
-            click.echo(f'{i.parent}/{{ "{old}" => "{new}" }}{trailing_slash}')
-            if prune:
-                i.rename(i.parent / new_filename)
+            lines.append(f'{MARK_RENAME}{parent}/{{ "{old}" => "{new}" }}{trailing_slash}')
+        click.echo("\n".join(lines))
+        if prune:
+            rename_paths(state.cleanup)
 
     if verbose:
         # ○ ◎ ● ⊕ ☑ ☒ □ ■ ⌫ ⌈
-        print("☒ [Remaining]")
-        for item in tree_dict_iterator(path_list_to_tree_dict(pending_list["normal"])):
-            print(item)
-
-    click.echo("\n--- Statistics ---")
-    click.echo(f'    Dir Total: {statistics["dir-total-count"]}')
-    click.echo(f'   File Total: {statistics["file-total-count"]}')
-    click.echo(f'Files Removed: {statistics["removed"]}')
-    click.echo(f'Files Renamed: {statistics["renamed"]}')
+        lines = ["☒ [Remaining]"]
+        lines.extend(tree_dict_iterator(path_list_to_tree_dict(state.normal)))
+        print("\n".join(lines))
+
+    click.echo(
+        "\n--- Statistics ---\n"
+        f"    Dir Total: {state.dir_count}\n"
+        f"   File Total: {state.file_count}\n"
+        f"Files Removed: {state.removed}\n"
+        f"Files Renamed: {state.renamed}"
+        + (f"\nFiles Skipped: {state.skipped}" if state.skipped else "")
+    )
+    if state.skipped:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,145 @@
+import random
+import re
+import unittest
+
+import cleanup
+
+# ASCII names, the only ones scanned with hyperscan and matched with the re.ASCII patterns
+ALPHABET = "abfkoqsxyzK-_@19 \t\x1c"
+random.seed(0)
+NAMES = ["", "fob", "fooob", "foooob", "zzy", "zzzy", "x{,}", "a{}", "ac", "qqq", "xy", "bb"] + [
+    "".join(random.choice(ALPHABET) for _ in range(random.randint(1, 8))) for _ in range(3000)
+]
+
+# source => hyperscan expression
+TRANSLATIONS = {
+    r"fo{,3}b": r"fo{0,3}b",  # a literal to hyperscan
+    r"zz{,2}y": r"zz{0,2}y",
+    r"x{,}": r"x{0,}",
+    r"a{}": r"a\{}",
+    r"(?>a|b)c": r"(?:a|b)c",  # atomic groups and possessive quantifiers are dropped
+    r"q++": r"q+",
+    r"a{2,}+b": r"a{2,}b",
+    r"(?P<n>x)y": r"(x)y",
+    r"\s": r"[\s\x1c-\x1f]",
+    r"(?a)ab": r"ab",
+    r"(?i:ab)": r"(?i:ab)",
+    r"\d+": r"\d+",
+    r"\bab": r"\bab",
+    r"^[-_@]+": r"^[-_@]+",
+}
+
+UNTRANSLATABLE = [
+    r"(a)\1",  # back-references
+    r"(?P<n>a)(?P=n)",
+    r"(?<=x)y",  # lookarounds
+    r"(?=x)",
+    r"\xe9",  # escapes of non-ASCII characters
+    r"\N{LATIN SMALL LETTER E WITH ACUTE}",
+    "[\N{LATIN SMALL LETTER E WITH ACUTE}]",
+    "\N{KELVIN SIGN}",  # folds to "k"
+    r"(?x)a b",
+]
+
+
+def searches(source, flags=re.IGNORECASE):
+    regex = re.compile(source, flags)
+    return {name for name in NAMES if regex.search(name)}
+
+
+class HyperscanSourceTest(unittest.TestCase):
+    def test_translations(self):
+        for source, expected in TRANSLATIONS.items():
+            with self.subTest(source=source):
+                self.assertEqual(cleanup.hyperscan_source(source), expected)
+
+    def test_untranslatable(self):
+        for source in UNTRANSLATABLE:
+            with self.subTest(source=source):
+                self.assertIsNone(cleanup.hyperscan_source(source))
+
+    def test_superset(self):
+        # read as re, a translation matches every ASCII name the source matches
+        for source in TRANSLATIONS:
+            with self.subTest(source=source):
+                translated = cleanup.hyperscan_source(source)
+                self.assertLessEqual(searches(source), searches(translated))
+
+    @unittest.skipIf(cleanup.hyperscan is None, "hyperscan is not installed")
+    def test_superset_hyperscan(self):
+        for source in TRANSLATIONS:
+            with self.subTest(source=source):
+                db = cleanup.build_hyperscan_database({0: cleanup.hyperscan_source(source)})
+                self.assertIsNotNone(db)
+                hits = {name for name in NAMES if cleanup.scan_hyperscan(db, name)}
+                self.assertLessEqual(searches(source), hits)
+
+    @unittest.skipIf(cleanup.hyperscan is None, "hyperscan is not installed")
+    def test_compile_hyperscan_leaves_out(self):
+        regex_list = [re.compile(source) for source in ["fo{,3}b", r"(a)\1", "zz{,2}y"]]
+        _, rest = cleanup.compile_hyperscan(regex_list)
+        self.assertEqual(rest, [1])
+
+
+class CompileUnionTest(unittest.TestCase):
+    def test_matches_any_source(self):
+        sources = list(TRANSLATIONS)
+        expected = set().union(*(searches(source) for source in sources))
+        for ascii in (False, True):
+            with self.subTest(ascii=ascii):
+                union = cleanup.compile_union(sources, ascii=ascii)
+                self.assertEqual({name for name in NAMES if union.search(name)}, expected)
+
+    def test_back_references(self):
+        # the groups are numbered across the union, only the first source keeps its numbers
+        self.assertIsNone(cleanup.compile_union(["a", r"(b)\1"]))
+        self.assertIsNone(cleanup.compile_union(["a", r"(b)?(?(1)c|d)"]))
+        union = cleanup.compile_union([r"(b)\1", "a"])
+        self.assertTrue(union.search("bb"))
+        self.assertFalse(union.search("b"))
+
+    def test_global_flags(self):
+        union = cleanup.compile_union(["(?s)a.b", "(?-i:c)"])
+        self.assertTrue(union.search("a\nb"))
+        self.assertFalse(union.search("C"))
+
+    def test_kelvin_sign(self):
+        # "k" folds to the KELVIN SIGN without re.ASCII only: not a name for the ASCII union
+        self.assertTrue(cleanup.compile_union(["k"]).search("\N{KELVIN SIGN}"))
+        self.assertFalse(cleanup.compile_union(["k"], ascii=True).search("\N{KELVIN SIGN}"))
+        self.assertTrue(cleanup.compile_union(["k"], ascii=True).search("K"))
+
+
+class ScopeGlobalFlagsTest(unittest.TestCase):
+    def test_scope_global_flags(self):
+        self.assertEqual(cleanup.scope_global_flags("(?i)foo"), "(?i:foo)")
+        self.assertEqual(cleanup.scope_global_flags("(?a)(?s)x"), "(?as:x)")
+        self.assertEqual(cleanup.scope_global_flags("(?x)a b # c"), "(?x)a b # c")
+        self.assertEqual(cleanup.scope_global_flags("a(?i)"), "a(?i)")
+
+
+class AsciiSafeTest(unittest.TestCase):
+    def test_ascii_safe(self):
+        for source in ["abc", "^[-_@]+", "a.b", r"\.txt$", "(?i:ab)"]:
+            with self.subTest(source=source):
+                self.assertTrue(cleanup.ascii_safe(source))
+
+    def test_not_ascii_safe(self):
+        for source in [
+            r"\w", r"\d", r"\s", r"\b", r"\xe9", r"\N{LATIN SMALL LETTER E WITH ACUTE}",
+            r"\351", r"(a)\1", r"(?P<n>a)(?P=n)", "(?u)a", "\N{LATIN SMALL LETTER E WITH ACUTE}",
+            "\N{KELVIN SIGN}",
+        ]:
+            with self.subTest(source=source):
+                self.assertFalse(cleanup.ascii_safe(source))
+
+    def test_same_on_ascii_names(self):
+        for source in ["fo{,3}b", "[a-k]+", "s.x", "(?i:ab)"]:
+            with self.subTest(source=source):
+                self.assertEqual(
+                    searches(source, cleanup.regex_flags(source)), searches(source)
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()